@@ -1,42 +1,28 @@
 import csv
 import sys
 import math
-import cv2
 import numpy as np
 
-
-# ---------- Helpers ----------
-def moving_average(x, w):
-    if w <= 1:
-        return x
-    x = np.asarray(x, dtype=float)
-    kernel = np.ones(w) / w
-    return np.convolve(x, kernel, mode="same")
+from shutter_kernels import hysteresis
+from shutter_video import moving_average, open_gray_frames, percentiles, roi_metrics
 
 
+# ---------- Helpers ----------
 def find_segments(is_open, min_len=3):
     """Return list of (start_idx, end_idx) for contiguous True regions (inclusive)."""
-    segs = []
-    start = None
-    for i, v in enumerate(is_open):
-        if v and start is None:
-            start = i
-        if (not v) and start is not None:
-            end = i - 1
-            if end - start + 1 >= min_len:
-                segs.append((start, end))
-            start = None
-    if start is not None:
-        end = len(is_open) - 1
-        if end - start + 1 >= min_len:
-            segs.append((start, end))
-    return segs
+    m = np.asarray(is_open, dtype=bool)
+    # rising/falling edges of the mask, padded so runs touching either end close
+    padded = np.concatenate(([False], m, [False]))
+    d = np.diff(padded.view(np.int8))
+    starts = np.flatnonzero(d == 1)
+    ends = np.flatnonzero(d == -1) - 1
+    keep = (ends - starts + 1) >= min_len
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
 
 
 def robust_levels(signal, lo_p=10, hi_p=90):
-    s = np.asarray(signal, dtype=float)
-    lo = float(np.percentile(s, lo_p))
-    hi = float(np.percentile(s, hi_p))
+    s = np.asarray(signal, dtype=np.float32).ravel()
+    lo, hi = percentiles(s, (lo_p, hi_p))
     mid = (lo + hi) / 2.0
     return mid, lo, hi
 
@@ -46,16 +32,9 @@ def hysteresis_states(signal, thr_open, thr_close):
       - if state is closed, only open when signal >= thr_open
       - if state is open, only close when signal <= thr_close
     """
-    s = np.asarray(signal, dtype=float)
-    out = np.zeros(len(s), dtype=bool)
-    state = False
-    for i, v in enumerate(s):
-        if not state and v >= thr_open:
-            state = True
-        elif state and v <= thr_close:
-            state = False
-        out[i] = state
-    return out
+    s = np.ascontiguousarray(signal, dtype=np.float32)
+    return hysteresis(s, float(thr_open), float(thr_close))
+
 
 def merge_close_segments(segs, gap_frames):
     """
@@ -64,15 +43,13 @@ def merge_close_segments(segs, gap_frames):
     """
     if not segs:
         return []
-    segs = sorted(segs, key=lambda x: x[0])
-    out = [list(segs[0])]
-    for s, e in segs[1:]:
-        ps, pe = out[-1]
-        if s - pe - 1 <= gap_frames:
-            out[-1][1] = max(pe, e)
-        else:
-            out.append([s, e])
-    return [tuple(x) for x in out]
+    arr = np.asarray(sorted(segs, key=lambda x: x[0]), dtype=np.int64)
+    s, e = arr[:, 0], arr[:, 1]
+    # gap to the furthest end seen so far (== end of the group being built)
+    gaps = s[1:] - np.maximum.accumulate(e)[:-1] - 1
+    first = np.flatnonzero(np.r_[True, gaps > gap_frames])
+    ends = np.maximum.reduceat(e, first)
+    return list(zip(s[first].tolist(), ends.tolist()))
 
 
 def pick_one_segment_per_pulse(segs, fps, gap_s=2.0):
@@ -107,32 +84,6 @@ def pick_one_segment_per_pulse(segs, fps, gap_s=2.0):
     return out
 
 
-def frame_to_gray(frame):
-    # OpenCV sometimes returns already-grayscale frames depending on codec.
-    if frame is None:
-        return None
-    if len(frame.shape) == 2:
-        return frame
-    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-
-def star_metric(gray, topk=80):
-    """
-    Robust for a star-like point source anywhere in the frame:
-    metric = mean(top K brightest pixels) - median(pixel values)
-    """
-    g = gray.astype(np.float32, copy=False)
-    flat = g.reshape(-1)
-
-    # Background estimate
-    med = float(np.median(flat))
-
-    # TopK brightest pixels anywhere
-    k = int(max(1, min(topk, flat.size)))
-    top = np.partition(flat, -k)[-k:]
-    return float(np.mean(top) - med)
-
-
 # ---------- Main ----------
 def main(video_path, output_csv="shutter_timing_results.csv"):
     # Tunables
@@ -142,37 +93,20 @@ def main(video_path, output_csv="shutter_timing_results.csv"):
     HYST_FRAC = 0.03        # fraction of swing for hysteresis band
     MODE = "full"           # "any" or "full"
     FULL_FRAC = 0.97        # for MODE="full": require near-max brightness
+    ROI_PROBE_S = 20.0      # look this far in for the first opening to place the ROI (sweeps start ~5 s + gap in)
+    ROI_HALF = 64           # metric window is (2*ROI_HALF)^2 px around the blob
 
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise RuntimeError(f"Could not open video: {video_path}")
-
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    fps, n_frames, frames = open_gray_frames(video_path)
     MERGE_GAP_FRAMES = int(0.30 * fps)   # ~150 frames at 508 fps
 
     if not fps or math.isnan(fps) or fps <= 1:
         fps = 110.0
         print("[WARN] FPS metadata missing. Using 110 fps fallback.")
 
-    metrics = []
-    frame_count = 0
-
-    while True:
-        ok, frame = cap.read()
-        if not ok:
-            break
-        frame_count += 1
-
-        gray = frame_to_gray(frame)
-        if gray is None or gray.size == 0:
-            continue
-
-        m = star_metric(gray, topk=TOPK)
-        metrics.append(m)
-
-    cap.release()
+    metrics = roi_metrics(video_path, frames, fps, TOPK, n_hint=n_frames,
+                          probe_s=ROI_PROBE_S, half=ROI_HALF)
 
-    metrics = np.asarray(metrics, dtype=float)
+    metrics = np.asarray(metrics, dtype=np.float32)
     if len(metrics) < 10:
         raise RuntimeError("Video too short or failed to read frames.")
 
@@ -227,7 +161,8 @@ def main(video_path, output_csv="shutter_timing_results.csv"):
     segs = pick_one_segment_per_pulse(segs, fps, gap_s=GAP_S)
     print(f"Final segments (1 per pulse window): {len(segs)}")
 
-    crossings = np.sum((sm[:-1] >= full_thr_open) != (sm[1:] >= full_thr_open))
+    above = sm >= full_thr_open
+    crossings = int(np.count_nonzero(np.diff(above.view(np.int8))))
     print("Raw crossings vs full_thr_open:", crossings)
 
     # Output CSV
@@ -1,44 +1,16 @@
 import csv
 import sys
 import math
-import cv2
 import numpy as np
 
-
-# ----------------- Helpers -----------------
-def moving_average(x, w):
-    if w <= 1:
-        return x
-    x = np.asarray(x, dtype=float)
-    kernel = np.ones(w, dtype=float) / float(w)
-    return np.convolve(x, kernel, mode="same")
-
-
-def frame_to_gray(frame):
-    if frame is None:
-        return None
-    if len(frame.shape) == 2:
-        return frame
-    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-
-def star_metric(gray, topk=200):
-    """
-    For star-like point source anywhere:
-    metric = mean(top K brightest pixels) - median(background)
-    """
-    g = gray.astype(np.float32, copy=False)
-    flat = g.reshape(-1)
-    med = float(np.median(flat))
-    k = int(max(1, min(int(topk), flat.size)))
-    top = np.partition(flat, -k)[-k:]
-    return float(np.mean(top) - med)
+from shutter_kernels import hysteresis, segment_summary
+from shutter_video import moving_average, open_gray_frames, percentiles, roi_metrics
 
 
+# ----------------- Helpers -----------------
 def robust_levels(signal, lo_p=10, hi_p=90):
-    s = np.asarray(signal, dtype=float)
-    lo = float(np.percentile(s, lo_p))
-    hi = float(np.percentile(s, hi_p))
+    s = np.asarray(signal, dtype=np.float32).ravel()
+    lo, hi = percentiles(s, (lo_p, hi_p))
     mid = 0.5 * (lo + hi)
     return mid, lo, hi
 
@@ -48,60 +20,48 @@ def hysteresis_states(signal, thr_open, thr_close):
     closed -> open when >= thr_open
     open   -> close when <= thr_close
     """
-    s = np.asarray(signal, dtype=float)
-    out = np.zeros(len(s), dtype=bool)
-    state = False
-    for i, v in enumerate(s):
-        if (not state) and v >= thr_open:
-            state = True
-        elif state and v <= thr_close:
-            state = False
-        out[i] = state
-    return out
+    s = np.ascontiguousarray(signal, dtype=np.float32)
+    return hysteresis(s, float(thr_open), float(thr_close))
 
 
 def find_segments(mask, min_len=3):
-    segs = []
-    start = None
-    for i, v in enumerate(mask):
-        if v and start is None:
-            start = i
-        if (not v) and start is not None:
-            end = i - 1
-            if end - start + 1 >= min_len:
-                segs.append((start, end))
-            start = None
-    if start is not None:
-        end = len(mask) - 1
-        if end - start + 1 >= min_len:
-            segs.append((start, end))
-    return segs
+    m = np.asarray(mask, dtype=bool)
+    # rising/falling edges of the mask, padded so runs touching either end close
+    padded = np.concatenate(([False], m, [False]))
+    d = np.diff(padded.view(np.int8))
+    starts = np.flatnonzero(d == 1)
+    ends = np.flatnonzero(d == -1) - 1
+    keep = (ends - starts + 1) >= min_len
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
 
 def merge_close_segments(segs, gap_frames):
     """Merge segments if they are separated by <= gap_frames."""
     if not segs:
         return []
-    segs = sorted(segs)
-    out = [list(segs[0])]
-    for s, e in segs[1:]:
-        if s - out[-1][1] <= gap_frames:
-            out[-1][1] = max(out[-1][1], e)
-        else:
-            out.append([s, e])
-    return [(s, e) for s, e in out]
+    arr = np.asarray(sorted(segs), dtype=np.int64)
+    s, e = arr[:, 0], arr[:, 1]
+    # gap measured from the furthest end so far (the current merged segment)
+    gaps = s[1:] - np.maximum.accumulate(e)[:-1]
+    first = np.flatnonzero(np.r_[True, gaps > gap_frames])
+    ends = np.maximum.reduceat(e, first)
+    return list(zip(s[first].tolist(), ends.tolist()))
 
 
-def segment_stats(sm, s, e):
-    """Compute peak above baseline and AUC above baseline for a segment."""
+def segment_stats(sm, s, e, baseline):
+    """
+    Compute peak above baseline and AUC above baseline for a segment.
+    baseline is the global 10th percentile of sm (the 'closed~lo' level);
+    it doesn't depend on the segment, so callers compute it once.
+    """
     seg = sm[s:e+1]
-    baseline = float(np.percentile(sm, 10))   # same idea as your 'closed~lo'
     peak = float(np.max(seg))
     peak_bs = peak - baseline
     auc_bs = float(np.sum(np.maximum(seg - baseline, 0.0)))  # in "metric*frames"
     return peak_bs, auc_bs, baseline
 
 
-def filter_segments_by_strength(segs, sm, fps, peak_min_bs=10.0, auc_min_ms=5.0):
+def filter_segments_by_strength(segs, sm, fps, baseline, peak_min_bs=10.0, auc_min_ms=5.0):
     """
     Remove tiny chatter segments.
     - peak_min_bs: minimum peak above baseline (kills your peak_bs=1 junk)
@@ -109,7 +69,7 @@ def filter_segments_by_strength(segs, sm, fps, peak_min_bs=10.0, auc_min_ms=5.0)
     """
     kept = []
     for s, e in segs:
-        peak_bs, auc_bs_frames, baseline = segment_stats(sm, s, e)
+        peak_bs, auc_bs_frames, _ = segment_stats(sm, s, e, baseline)
 
         # Convert auc from (metric*frames) -> (metric*seconds)
         auc_bs_s = auc_bs_frames / fps
@@ -121,7 +81,7 @@ def filter_segments_by_strength(segs, sm, fps, peak_min_bs=10.0, auc_min_ms=5.0)
     return kept
 
 
-def pick_one_segment_per_pulse_window(segs, sm, fps, boundary_gap_s=1.0):
+def pick_one_segment_per_pulse_window(segs, sm, fps, baseline, boundary_gap_s=1.0):
     """
     If multiple segments still occur within a single pulse window,
     cluster by time gaps and keep the strongest (max AUC) segment per cluster.
@@ -149,7 +109,7 @@ def pick_one_segment_per_pulse_window(segs, sm, fps, boundary_gap_s=1.0):
         best_seg = None
         best_auc = -1.0
         for s, e in group:
-            _, auc_bs_frames, _ = segment_stats(sm, s, e)
+            _, auc_bs_frames, _ = segment_stats(sm, s, e, baseline)
             auc_bs_s = auc_bs_frames / fps
             if auc_bs_s > best_auc:
                 best_auc = auc_bs_s
@@ -160,25 +120,6 @@ def pick_one_segment_per_pulse_window(segs, sm, fps, boundary_gap_s=1.0):
     return best
 
 
-def first_crossing_time(frames, values, thr):
-    """
-    Return first frame index in this pulse where values >= thr.
-    frames: np.array of absolute frame indices
-    values: np.array metric values aligned with frames
-    """
-    idx = np.where(values >= thr)[0]
-    if idx.size == 0:
-        return None
-    return int(frames[idx[0]])
-
-
-def last_crossing_time(frames, values, thr):
-    idx = np.where(values >= thr)[0]
-    if idx.size == 0:
-        return None
-    return int(frames[idx[-1]])
-
-
 # ----------------- Main -----------------
 def main(video_path,
          out_summary_csv="pulse_flux_summary.csv",
@@ -190,32 +131,21 @@ def main(video_path,
     MIN_LEN_FRAMES = 3    # ignore tiny flicker segments
     HYST_FRAC = 0.10      # hysteresis band fraction of swing
     MERGE_GAP_FRAMES = 12 # merge brief dropouts (~ at 508fps: 12 frames ~ 24ms)
+    ROI_PROBE_S = 20.0    # look this far in for the first opening to place the ROI (sweeps start ~5 s + gap in)
+    ROI_HALF = 64         # metric window is (2*ROI_HALF)^2 px around the blob
 
     # Pulse-local threshold fractions (relative to that pulse's own peak)
     FRACS = [0.10, 0.50, 0.90]  # time above 10%, 50%, 90% of peak (after baseline subtraction)
 
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise RuntimeError(f"Could not open video: {video_path}")
-
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    fps, n_frames, frames = open_gray_frames(video_path)
     if not fps or math.isnan(fps) or fps <= 1:
         fps = 110.0
         print("[WARN] FPS metadata missing. Using 110 fps fallback.")
 
-    metrics = []
-    while True:
-        ok, frame = cap.read()
-        if not ok:
-            break
-        gray = frame_to_gray(frame)
-        if gray is None or gray.size == 0:
-            metrics.append(0.0)
-            continue
-        metrics.append(star_metric(gray, topk=TOPK))
-    cap.release()
-
-    metrics = np.asarray(metrics, dtype=float)
+    metrics = roi_metrics(video_path, frames, fps, TOPK, n_hint=n_frames,
+                          probe_s=ROI_PROBE_S, half=ROI_HALF, empty=0.0)
+
+    metrics = np.asarray(metrics, dtype=np.float32)
     if metrics.size < 10:
         raise RuntimeError("Video too short or failed to read frames.")
 
@@ -247,15 +177,17 @@ def main(video_path,
 
     # Kill chatter: this is the key fix for your "41 instead of 24" problem
     # In your run, junk segments have peak_bs=1.0; real ones are ~255.
+    # Global baseline for the strength filters: the 10th percentile is lo from robust_levels
+    baseline_global = float(lo)
     segs = filter_segments_by_strength(
-        segs, sm, fps,
+        segs, sm, fps, baseline_global,
         peak_min_bs=10.0,     # keep anything with real brightness
         auc_min_ms=5.0        # optional; helps remove single-frame junk
     )
 
     # If you still occasionally get more than expected, cluster within pulse windows:
     # Estimate a boundary gap from your sweep gap (if you used ~2s, use 1.0–1.5s here).
-    segs = pick_one_segment_per_pulse_window(segs, sm, fps, boundary_gap_s=2.0)
+    segs = pick_one_segment_per_pulse_window(segs, sm, fps, baseline_global, boundary_gap_s=2.0)
 
     print(f"Final pulse segments: {len(segs)}")
 
@@ -281,9 +213,9 @@ def main(video_path,
 
     # ---- Summary per pulse ----
     summary_rows = []
+    fracs_arr = np.asarray(FRACS, dtype=np.float64)
     for pid, (s, e) in enumerate(segs, start=1):
-        frames = np.arange(s, e + 1, dtype=int)
-        vals = sm[s:e + 1]
+        vals = np.ascontiguousarray(sm[s:e + 1], dtype=np.float32)
 
         # Baseline for THIS pulse: take a small window before pulse if available, else global lo
         pre_n = int(min(50, s))  # up to 50 frames pre
@@ -292,35 +224,29 @@ def main(video_path,
         else:
             baseline = float(lo)
 
-        vals_bs = vals - baseline  # baseline-subtracted
-        vals_bs[vals_bs < 0] = 0.0
-
-        peak = float(np.max(vals_bs))
-        peak_idx = int(np.argmax(vals_bs))
-        peak_frame = int(frames[peak_idx])
+        # One pass over the baseline-subtracted (clipped at 0) values:
+        # peak, its index, summed flux, and first/last frame above each fraction of peak
+        peak, peak_idx, auc_frames, f_first, f_last = segment_summary(vals, baseline, fracs_arr)
+        peak = float(peak)
+        peak_frame = s + int(peak_idx)
 
         dur_frames = int(e - s + 1)
         dur_ms = 1000.0 * dur_frames / fps
 
         # Integrated flux (area above baseline) in "metric*seconds"
         # dt = 1/fps
-        auc = float(np.sum(vals_bs) / fps)
+        auc = float(auc_frames / fps)
 
         # Fractions-of-peak timings
         frac_results = {}
-        if peak > 1e-9:
-            for frac in FRACS:
-                thr = frac * peak
-                f_start = first_crossing_time(frames, vals_bs, thr)
-                f_end = last_crossing_time(frames, vals_bs, thr)
-                if f_start is None or f_end is None or f_end < f_start:
-                    frac_results[frac] = (None, None, 0.0)
-                else:
-                    t_ms = 1000.0 * (f_end - f_start + 1) / fps
-                    frac_results[frac] = (f_start, f_end, t_ms)
-        else:
-            for frac in FRACS:
+        for j, frac in enumerate(FRACS):
+            if peak <= 1e-9 or f_first[j] < 0:
                 frac_results[frac] = (None, None, 0.0)
+            else:
+                f_start = s + int(f_first[j])
+                f_end = s + int(f_last[j])
+                t_ms = 1000.0 * (f_end - f_start + 1) / fps
+                frac_results[frac] = (f_start, f_end, t_ms)
 
         row = {
             "pulse_id": pid,
@@ -0,0 +1,169 @@
+"""
+Numba kernels shared by analyze_shutter_avi.py and analyze_shutter_flux.py.
+
+The analysis scripts are one-shot CLI tools, so JIT warm-up is noticeable on
+short videos. Build the serial kernels ahead of time once with:
+
+    python shutter_kernels.py
+
+This writes the shutter_kernels_aot extension next to this file. When it is
+present the AOT versions are used; otherwise the @njit(cache=True) versions
+below are. reduce_batch is always JIT: AOT can't build parallel (prange) loops.
+numba itself is optional; without it everything runs as plain Python.
+"""
+import os
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+def _hysteresis(s, thr_open, thr_close):
+    out = np.empty(s.shape[0], np.bool_)
+    state = False
+    for i in range(s.shape[0]):
+        if (not state) and s[i] >= thr_open:
+            state = True
+        elif state and s[i] <= thr_close:
+            state = False
+        out[i] = state
+    return out
+
+
+def _hist_metric(hist, npix, k):
+    """
+    mean(top k values) - median from a 256-bin uint8 histogram of npix pixels.
+    Exact: same numbers as np.median / np.partition on the pixels themselves.
+    """
+    # values at sorted positions half-1 and half (np.median averages them for even npix)
+    half = npix // 2
+    med_lo = -1
+    med_hi = -1
+    cum = 0
+    for b in range(256):
+        cum += hist[b]
+        if med_lo < 0 and cum > half - 1:
+            med_lo = b
+        if cum > half:
+            med_hi = b
+            break
+    if npix % 2:
+        med = float(med_hi)
+    else:
+        med = 0.5 * (med_lo + med_hi)
+
+    # top k: take pixels from the brightest bins down
+    need = k
+    acc = 0
+    for b in range(255, -1, -1):
+        take = min(hist[b], need)
+        acc += take * b
+        need -= take
+        if need == 0:
+            break
+    return acc / k - med
+
+
+def _segment_summary(vals, baseline, fracs):
+    """
+    Per-pulse stats on max(vals - baseline, 0) without temporary arrays:
+    peak, first argmax, sum (AUC in metric*frames), and for each frac the
+    first/last index with value >= frac*peak (-1 if none).
+    """
+    n = vals.shape[0]
+    peak = 0.0
+    peak_idx = 0
+    auc = 0.0
+    for i in range(n):
+        v = vals[i] - baseline
+        if v < 0.0:
+            v = 0.0
+        auc += v
+        if v > peak or i == 0:
+            peak = v
+            peak_idx = i
+
+    m = fracs.shape[0]
+    first = np.full(m, -1, np.int64)
+    last = np.full(m, -1, np.int64)
+    for i in range(n):
+        v = vals[i] - baseline
+        if v < 0.0:
+            v = 0.0
+        for j in range(m):
+            if v >= fracs[j] * peak:
+                if first[j] < 0:
+                    first[j] = i
+                last[j] = i
+    return peak, peak_idx, auc, first, last
+
+
+def _segment_summary_np(vals, baseline, fracs):
+    """NumPy version of _segment_summary for when numba is missing."""
+    v = np.maximum(vals - baseline, 0.0)
+    peak_idx = int(v.argmax())
+    peak = float(v[peak_idx])
+    auc = float(v.sum(dtype=np.float64))
+    first = np.full(fracs.shape[0], -1, np.int64)
+    last = np.full(fracs.shape[0], -1, np.int64)
+    for j in range(fracs.shape[0]):
+        above = v >= fracs[j] * peak
+        # argmax on bool stops at the first True; no index array needed
+        i = int(above.argmax())
+        if above[i]:
+            first[j] = i
+            last[j] = above.size - 1 - int(above[::-1].argmax())
+    return peak, peak_idx, auc, first, last
+
+
+_hist_metric_jit = njit(cache=True)(_hist_metric)
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def reduce_batch(frames, topk, out):
+    """
+    star_metric for a (N, H, W) uint8 stack, one frame per core (prange):
+    out[n] = mean(top K pixels) - median, both from a 256-bin histogram.
+    """
+    npix = frames.shape[1] * frames.shape[2]
+    k = max(1, min(topk, npix))
+    for n in prange(frames.shape[0]):
+        hist = np.zeros(256, np.int64)
+        for y in range(frames.shape[1]):
+            for x in range(frames.shape[2]):
+                hist[frames[n, y, x]] += 1
+
+        out[n] = _hist_metric_jit(hist, npix, k)
+
+
+try:
+    from shutter_kernels_aot import hysteresis, hist_metric, segment_summary
+except ImportError:
+    hysteresis = njit(cache=True, fastmath=True)(_hysteresis)
+    hist_metric = _hist_metric_jit
+    segment_summary = njit(cache=True)(_segment_summary) if HAVE_NUMBA else _segment_summary_np
+
+
+def build_aot():
+    from numba.pycc import CC
+
+    cc = CC("shutter_kernels_aot")
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export("hysteresis", "b1[:](f4[:], f8, f8)")(_hysteresis)
+    cc.export("hist_metric", "f8(i8[:], i8, i8)")(_hist_metric)
+    cc.export("segment_summary", "Tuple((f8, i8, f8, i8[:], i8[:]))(f4[:], f8, f8[:])")(_segment_summary)
+    cc.compile()
+    print(f"Wrote shutter_kernels_aot to {cc.output_dir}")
+
+
+if __name__ == "__main__":
+    build_aot()
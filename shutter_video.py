@@ -0,0 +1,443 @@
+"""
+Video decode and per-frame star metric shared by analyze_shutter_avi.py and
+analyze_shutter_flux.py: grayscale frame sources (NVDEC or OpenCV/FFmpeg),
+blob ROI cropping, background prefetch, and the batched metric pass.
+The numba kernels these use live in shutter_kernels.py.
+"""
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+from shutter_kernels import HAVE_NUMBA, hist_metric, reduce_batch
+
+try:
+    import PyNvCodec as nvc
+except ImportError:
+    # optional NVDEC decode (VPF / PyNvCodec); OpenCV is used without it
+    nvc = None
+
+try:
+    import cupy as cp
+except ImportError:
+    # optional: with CuPy, NVDEC frames stay on the GPU for star_metric
+    cp = None
+
+NVDEC_GPU_ID = 0
+
+# OpenCV/FFmpeg decode for H.264 sources on the GPU (cuvid) when FFmpeg has it
+FFMPEG_CUVID_OPTIONS = "hwaccel;cuvid|video_codec;h264_cuvid|vsync;0"
+H264_FOURCCS = {"H264", "h264", "X264", "x264", "avc1", "AVC1"}
+
+# Decoded pixel formats whose raw frame (CONVERT_RGB off) starts with a full-range
+# 8-bit luma plane, i.e. is the grayscale image as-is. Anything else (packed YUYV,
+# RGBA, 16-bit gray, limited-range 16-235 YUV from I420/XVID/H.264) goes through
+# OpenCV's BGR conversion and BGR -> GRAY instead.
+RAW_GRAY_PIXEL_FORMATS = {"Y800", "GREY"}
+# MJPEG decodes to full-range planar YUV (FFmpeg's yuvj420p / yuvj422p)
+MJPEG_FOURCCS = {"MJPG", "mjpg"}
+MJPEG_PLANAR_PIXEL_FORMATS = {"I420", "IYUV", "Y42B"}
+
+REDUCE_BATCH = 128  # frames per parallel reduce_batch call
+METRICS_GROW = 65536  # metrics buffer growth when the container frame count is off
+
+
+def moving_average(x, w):
+    if w <= 1:
+        return x
+    x = np.asarray(x, dtype=np.float32)
+    if x.size < w:
+        return np.convolve(x, np.ones(w) / w, mode="same").astype(np.float32)
+    # Box filter as a difference of cumulative sums: O(N) for any w.
+    # Zero padding on both sides matches np.convolve(..., mode="same").
+    # The running sum is float64 (float32 would drift over long videos).
+    padded = np.concatenate((np.zeros(w // 2, np.float32), x, np.zeros((w - 1) // 2, np.float32)))
+    cs = np.concatenate(([0.0], np.cumsum(padded, dtype=np.float64)))
+    return ((cs[w:] - cs[:-w]) / w).astype(np.float32)
+
+
+def percentiles(s, ps):
+    """
+    Same values as np.percentile (linear interpolation) for several
+    percentiles, using one np.partition over all the needed order statistics.
+    """
+    n = s.size
+    pos = np.asarray(ps, dtype=float) / 100.0 * (n - 1)
+    i0 = np.floor(pos).astype(np.intp)
+    i1 = np.minimum(i0 + 1, n - 1)
+    part = np.partition(s, np.unique(np.r_[i0, i1]))
+    a = part[i0].astype(float)
+    b = part[i1].astype(float)
+    return (a + (pos - i0) * (b - a)).tolist()
+
+
+def frame_to_gray(frame, height=None):
+    # OpenCV sometimes returns already-grayscale frames depending on codec.
+    if frame is None:
+        return None
+    if len(frame.shape) == 2:
+        # Raw planar YUV (CONVERT_RGB off) can come back as one buffer with the
+        # chroma planes below the image: the top H rows are the Y (luma) plane.
+        if height and frame.shape[0] > height:
+            return frame[:height]
+        return frame
+    if frame.shape[2] == 4:
+        return cv2.cvtColor(frame, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def _surface_luma(surface, w, h):
+    """Zero-copy CuPy view of the Y plane of a decoded NV12 surface."""
+    plane = surface.PlanePtr()
+    pitch = plane.Pitch()
+    mem = cp.cuda.UnownedMemory(plane.GpuMem(), pitch * h, surface)
+    return cp.ndarray((h, w), dtype=cp.uint8,
+                      memptr=cp.cuda.MemoryPointer(mem, 0), strides=(pitch, 1))
+
+
+def _nvdec_gray_frames(dec, gpu_id):
+    """
+    Yield the luma (Y) plane of each NVDEC frame; NV12 luma is already grayscale.
+    With CuPy the plane is yielded as a device array (no host transfer),
+    otherwise it is downloaded to host memory. Each frame gets its own
+    buffer since decoder surfaces are recycled and frames may be queued.
+    """
+    w, h = dec.Width(), dec.Height()
+    if cp is not None:
+        while True:
+            surface = dec.DecodeSingleSurface()
+            if surface.Empty():
+                break
+            yield _surface_luma(surface, w, h).copy()
+        return
+
+    downloader = nvc.PySurfaceDownloader(w, h, nvc.PixelFormat.NV12, gpu_id)
+    while True:
+        surface = dec.DecodeSingleSurface()
+        if surface.Empty():
+            break
+        nv12 = np.empty(w * h * 3 // 2, dtype=np.uint8)
+        if not downloader.DownloadSingleSurface(surface, nv12):
+            break
+        yield nv12[:w * h].reshape(h, w)
+
+
+def _fourcc(cap, prop=cv2.CAP_PROP_FOURCC):
+    code = int(cap.get(prop)) & 0xFFFFFFFF   # unset properties read back as -1
+    return code.to_bytes(4, "little").decode("ascii", "replace")
+
+
+def _raw_luma_ok(cap):
+    """True if the decoded pixel format's raw frame is already the grayscale image."""
+    prop = getattr(cv2, "CAP_PROP_CODEC_PIXEL_FORMAT", None)
+    if prop is None:
+        return False
+    pix_fmt = _fourcc(cap, prop)
+    if pix_fmt in RAW_GRAY_PIXEL_FORMATS:
+        return True
+    return _fourcc(cap) in MJPEG_FOURCCS and pix_fmt in MJPEG_PLANAR_PIXEL_FORMATS
+
+
+def _open_cv2_capture(video_path):
+    """
+    Open with the FFmpeg backend. Sources that decode to full-range 8-bit luma
+    (gray, MJPEG) are read raw (CONVERT_RGB off) and hand back their Y plane
+    instead of YUV -> BGR -> GRAY; everything else keeps the BGR conversion.
+    H.264 files are re-opened with cuvid decode if FFmpeg supports it.
+    """
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    if not cap.isOpened():
+        return cv2.VideoCapture(video_path)
+
+    if "OPENCV_FFMPEG_CAPTURE_OPTIONS" not in os.environ and _fourcc(cap) in H264_FOURCCS:
+        os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = FFMPEG_CUVID_OPTIONS
+        hw_cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+        if hw_cap.isOpened():
+            cap.release()
+            cap = hw_cap
+        else:
+            del os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"]
+
+    if _raw_luma_ok(cap):
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    return cap
+
+
+def _cv2_gray_frames(cap):
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    # Raw MJPEG frames are yuvj420p, which OpenCV warns about on every frame
+    # ("treated as 8UC1") although the first plane is exactly the luma we want.
+    # Quiet that only while reading a source _raw_luma_ok accepted as MJPEG.
+    quiet = not cap.get(cv2.CAP_PROP_CONVERT_RGB) and _fourcc(cap) in MJPEG_FOURCCS
+    if quiet:
+        log_level = cv2.utils.logging.getLogLevel()
+        cv2.utils.logging.setLogLevel(cv2.utils.logging.LOG_LEVEL_ERROR)
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame_to_gray(frame, height)
+    finally:
+        cap.release()
+        if quiet:
+            cv2.utils.logging.setLogLevel(log_level)
+
+
+def open_gray_frames(video_path, gpu_id=NVDEC_GPU_ID):
+    """
+    Return (fps, frame count hint, iterator over grayscale frames).
+    The frame count comes from container metadata (0 if unknown) and can be off.
+    Decodes on the GPU with NVDEC when PyNvCodec is installed and the codec
+    is supported; otherwise falls back to cv2.VideoCapture (FFmpeg).
+    """
+    if nvc is not None:
+        try:
+            dec = nvc.PyNvDecoder(video_path, gpu_id)
+        except Exception as e:
+            print(f"[WARN] NVDEC decode unavailable ({e}). Using OpenCV decode.")
+        else:
+            return dec.Framerate(), dec.Numframes(), _nvdec_gray_frames(dec, gpu_id)
+
+    cap = _open_cv2_capture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Could not open video: {video_path}")
+    n_frames = max(0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    return cap.get(cv2.CAP_PROP_FPS), n_frames, _cv2_gray_frames(cap)
+
+
+def _swing_peak(lo, hi, min_contrast):
+    """(y, x) where the blurred max - min composite clearly peaks, else None."""
+    swing = cv2.GaussianBlur((hi - lo).astype(np.float32), (5, 5), 0)
+    _, peak, _, (x, y) = cv2.minMaxLoc(swing)
+    if peak < min_contrast or peak - float(np.median(swing)) < min_contrast:
+        return None
+    return y, x
+
+
+def find_blob_roi(frames, max_frames, half=64, min_contrast=20.0, check_every=16, extra_frames=64):
+    """
+    Locate the star blob from the start of a (separate) pass over the video.
+    Per-pixel min and max composites are kept until max - min clearly peaks,
+    i.e. the first shutter opening, plus extra_frames so the composite holds
+    the fully open blob. Static bright spots (hot pixels, reflections) are in
+    both composites and cancel out.
+    Returns (y0, y1, x0, x1) for a (2*half)^2 window, or None if no opening
+    shows up within max_frames or frames aren't host uint8 arrays (caller
+    then keeps the full frame).
+    """
+    lo = hi = None
+    stop_at = max_frames
+    for i, g in enumerate(frames):
+        if i >= stop_at:
+            break
+        if g is None or g.size == 0:
+            continue
+        if not (isinstance(g, np.ndarray) and g.ndim == 2 and g.dtype == np.uint8):
+            return None
+        if lo is None:
+            lo, hi = g.copy(), g.copy()
+            continue
+        if g.shape != lo.shape:
+            return None
+        np.minimum(lo, g, out=lo)
+        np.maximum(hi, g, out=hi)
+        if stop_at == max_frames and i % check_every == 0 and _swing_peak(lo, hi, min_contrast):
+            stop_at = min(max_frames, i + extra_frames)
+
+    if lo is None:
+        return None
+    peak = _swing_peak(lo, hi, min_contrast)
+    if peak is None:
+        return None
+    y, x = peak
+    h, w = lo.shape
+    y0, x0 = max(0, y - half), max(0, x - half)
+    y1, x1 = min(h, y + half), min(w, x + half)
+    return y0, y1, x0, x1
+
+
+def locate_roi(video_path, max_frames, half=64, min_contrast=20.0):
+    """find_blob_roi on its own decode of video_path (closed again afterwards)."""
+    _, _, probe = open_gray_frames(video_path)
+    try:
+        return find_blob_roi(probe, max_frames, half, min_contrast)
+    finally:
+        probe.close()
+
+
+def crop_to_roi(frames, roi):
+    """
+    Yield every frame cropped to roi = (y0, y1, x0, x1), so star_metric only
+    touches ~(2*half)^2 pixels per frame. With roi None frames pass through.
+    """
+    if roi is None:
+        yield from frames
+        return
+    y0, y1, x0, x1 = roi
+    for gray in frames:
+        yield gray[y0:y1, x0:x1] if gray is not None and gray.size else gray
+
+
+def prefetch_frames(frames, maxsize=64):
+    """
+    Run the frame iterator (decode) in a background thread, handing frames
+    over through a bounded queue. cap.read(), the NumPy reductions and the
+    reduce_batch kernel (nogil) all release the GIL, so decoding overlaps
+    with star_metric.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    done = object()
+
+    def producer():
+        try:
+            for frame in frames:
+                q.put(frame)
+        except BaseException as e:
+            q.put(e)
+        finally:
+            q.put(done)
+
+    t = threading.Thread(target=producer, daemon=True)
+    t.start()
+    while True:
+        item = q.get()
+        if item is done:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    t.join()
+
+
+def star_metric_gpu(gray, topk=200):
+    """
+    star_metric for a CuPy uint8 frame: the histogram, median and top-K
+    all run on the device; only the final float comes back to the host.
+    """
+    flat = gray.ravel()
+    n = flat.size
+    k = int(max(1, min(int(topk), n)))
+
+    hist = cp.bincount(flat, minlength=256)
+    cum = cp.cumsum(hist)
+    # value at sorted index i == number of bins whose cumulative count is <= i
+    med = (cum <= n // 2).sum().astype(cp.float64)
+    if n % 2 == 0:
+        med = 0.5 * (med + (cum <= n // 2 - 1).sum())
+
+    # brightest bins first; take at most (k - pixels already taken) from each
+    rev = hist[::-1]
+    brighter = cp.cumsum(rev) - rev
+    take = cp.clip(k - brighter, 0, rev)
+    top_sum = (take * cp.arange(255, -1, -1)).sum()
+    return float((top_sum / k - med).item())
+
+
+def star_metric(gray, topk=200):
+    """
+    Robust for a star-like point source anywhere in the frame:
+    metric = mean(top K brightest pixels) - median(pixel values)
+
+    Frames are uint8, so both terms are read off one 256-bin histogram
+    (no float32 copy, no median/partition over every pixel).
+    """
+    if cp is not None and isinstance(gray, cp.ndarray):
+        return star_metric_gpu(gray, topk)
+
+    flat = gray.reshape(-1)
+    n = flat.size
+    k = int(max(1, min(topk, n)))
+
+    if flat.dtype != np.uint8:
+        # Non-8-bit sources: fall back to the exact float path
+        g = flat.astype(np.float32, copy=False)
+        med = float(np.median(g))
+        top = np.partition(g, -k)[-k:]
+        return float(np.mean(top) - med)
+
+    hist = np.bincount(flat, minlength=256)
+    return float(hist_metric(hist, n, k))
+
+
+def compute_metrics(frames, topk, n_hint=0, batch=REDUCE_BATCH, empty=None):
+    """
+    star_metric for every frame, in order, written into a preallocated
+    float32 array sized from n_hint (grown by METRICS_GROW if it is short).
+    With numba, host uint8 frames are stacked into (batch, H, W) blocks and
+    reduced in parallel by reduce_batch straight into the output; other
+    frames (CuPy, non-uint8) go through star_metric one at a time.
+    Empty frames get `empty`, or are skipped when it is None.
+    """
+    metrics = np.empty(max(int(n_hint), batch), dtype=np.float32)
+    n_out = 0
+    buf = None
+    n = 0
+
+    def reserve(extra):
+        nonlocal metrics
+        if n_out + extra > metrics.size:
+            metrics = np.resize(metrics, max(metrics.size + METRICS_GROW, n_out + extra))
+
+    def put(value):
+        nonlocal n_out
+        reserve(1)
+        metrics[n_out] = value
+        n_out += 1
+
+    def flush():
+        nonlocal n, n_out
+        if n == 0:
+            return
+        reserve(n)
+        reduce_batch(buf[:n], int(topk), metrics[n_out:n_out + n])
+        n_out += n
+        n = 0
+
+    for gray in frames:
+        if gray is None or gray.size == 0:
+            flush()
+            if empty is not None:
+                put(empty)
+            continue
+
+        if not (HAVE_NUMBA and isinstance(gray, np.ndarray)
+                and gray.dtype == np.uint8 and gray.ndim == 2):
+            flush()
+            put(star_metric(gray, topk=topk))
+            continue
+
+        if buf is None or buf.shape[1:] != gray.shape:
+            flush()
+            buf = np.empty((batch,) + gray.shape, dtype=np.uint8)
+        buf[n] = gray
+        n += 1
+        if n == batch:
+            flush()
+
+    flush()
+    return metrics[:n_out]
+
+
+def roi_metrics(video_path, frames, fps, topk, n_hint=0, probe_s=20.0, half=64,
+                min_contrast=20.0, min_swing=10.0, empty=None):
+    """
+    compute_metrics over frames (from open_gray_frames(video_path)), measured
+    in a window around the blob when the first probe_s seconds show a shutter
+    opening. If the metric then hardly moves inside that window (min_swing,
+    peak to peak), the ROI was wrong: the video is measured again on the
+    full frame.
+    """
+    roi = locate_roi(video_path, int(probe_s * fps), half, min_contrast)
+    if roi is None:
+        print(f"[WARN] No shutter opening in the first {probe_s:.0f} s; using the full frame.")
+    else:
+        print("ROI: rows {}:{}, cols {}:{}".format(*roi))
+
+    metrics = compute_metrics(crop_to_roi(prefetch_frames(frames), roi), topk, n_hint=n_hint, empty=empty)
+    if roi is not None and metrics.size and float(metrics.max() - metrics.min()) < min_swing:
+        print("[WARN] Metric barely moves inside the ROI; measuring the full frame instead.")
+        _, _, frames = open_gray_frames(video_path)
+        metrics = compute_metrics(prefetch_frames(frames), topk, n_hint=n_hint, empty=empty)
+    return metrics
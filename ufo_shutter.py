@@ -1,11 +1,28 @@
 # ufo_shutter_pyfirmata.py
 
+import inspect
+import os
+import queue
+import select
+import struct
+import threading
 import time
 import sys
-from pyfirmata import Arduino, util
-from serial.serialutil import SerialException
-
-#!!!! When you install pyfrimata, in pyfirmata.py, change inspect.getargspec to inspect.getfullargspec @ line 185 !!!
+from collections import deque
+from dataclasses import dataclass
+from itertools import accumulate
+from pyfirmata import Arduino
+try:
+    import fcntl     # POSIX only
+    import termios
+except ImportError:
+    fcntl = termios = None
+from serial.serialutil import SerialException, SerialTimeoutException
+
+# pyfirmata still calls inspect.getargspec (pyfirmata.py line 185), which Python 3.11 removed.
+# Alias it here instead of hand-editing the installed pyfirmata.
+if not hasattr(inspect, "getargspec"):
+    inspect.getargspec = inspect.getfullargspec
 
 # --- CONFIG ---
 # Default serial port and pin; you can override from command line.
@@ -34,9 +51,17 @@ CAL_B = 53.67871603  # ms (since measured ≈ A*cmd - B)
 #Switching guards (tune these as needed)
 PRE_SWITCH_OPEN_SEC   = 0.5       # open + let V880/coil settle before switching
 PRE_SWITCH_CLOSE_SEC   = 2.0      # close + let V880/coil settle before switching
-POST_SWITCH_SETTLE_SEC = 5.0      # let relay contacts settle after switching
+POST_SWITCH_SETTLE_SEC = 5.0      # let relay contacts settle after switching (ceiling if feedback pin used); 2nd cmd-line arg overrides
+SETTLE_FEEDBACK_PIN = None        # e.g. 7: digital input wired to a relay feedback contact; None = fixed settle wait
+SETTLE_FEEDBACK_INVERT = False    # feedback input reads 1 when relays are ON; set True if your wiring reads 0
+SETTLE_STABLE_SEC = 0.05          # feedback must hold the new state this long to count as settled
 SECOND_CLOSE_AFTER_SWITCH = True  # helps ensure new shutter is in a known state
+FAST_SWITCH = False               # send the relay switch + that close in one frame (new shutter energizes while contacts settle)
 DELAY_BEFORE_COMMAND = 1.0      # wait time after selecting shutter before sending commands
+STARTUP_WAIT_SEC = 3.0          # max wait for the Firmata firmware report after connecting
+SERIAL_RETRIES = 3              # extra write attempts before treating the serial link as lost
+SERIAL_WRITE_TIMEOUT_SEC = 0.05 # a single frame write (incl. draining to the wire) that takes longer than this counts as failed
+DRAIN_POLL_SEC = 0.0002         # poll interval while waiting for a written frame to leave the driver
 
 #Params on how to exit script, and which state to leave shutter in
 EXIT_MODE = "open"   # "open" or "closed" # shutter state on exit, denergized is "open"
@@ -44,15 +69,151 @@ EXIT_RELAY = "on"           # relay state on exit: "on" (energized LEDs on) or "
 DO_BOARD_EXIT = False  # if False, we DON'T call board.exit() so pins stay latched more reliably
 
 
+# Firmata digital port holding both pins (D8..D15 -> port 1; D8 is bit 0, D9 is bit 1).
+# We keep our own copy of that port's output byte and send one 3-byte DIGITAL_MESSAGE
+# per state change, so shutter + relay changes can go out in a single write.
+DIGITAL_MESSAGE = 0x90
+PORT_NUM = SHUTTER_PIN_NUM // 8
+assert SELECT_PIN_NUM // 8 == PORT_NUM, "shutter and relay pins must share a Firmata port"
+SHUTTER_BIT = 1 << (SHUTTER_PIN_NUM % 8)
+SELECT_BIT = 1 << (SELECT_PIN_NUM % 8)
+_port_state = bytearray(1)   # output bits of PORT_NUM as last sent (pins start LOW)
+_port_known = False          # False until a write lands, and again after a failure or board reset
+REPORT_VERSION = 0xF9        # Firmata announces itself with this after a (re)boot
+_write_lat_ns = deque(maxlen=1000)   # write+drain time of recent port writes (see 'lat')
+_raw_sp = None   # POSIX: the serial port whose frames go out with os.write (set in main)
+_raw_fd = None   # ...and its file descriptor
+_TIOCOUTQ = getattr(termios, "TIOCOUTQ", None)   # bytes still queued in the tty driver
+# the complete DIGITAL_MESSAGE for every port byte, built once
+PORT_MSGS = tuple(bytes([DIGITAL_MESSAGE | PORT_NUM, st & 0x7F, (st >> 7) & 0x01]) for st in range(256))
+
+
+def raw_write(fd, frame, deadline_ns) -> None:
+    """
+    os.write the whole frame to pyserial's non-blocking fd. While the driver's
+    buffer is full, wait for room with select() up to deadline_ns (the raw path's
+    equivalent of pyserial's write_timeout), then SerialTimeoutException.
+    """
+    view = memoryview(frame)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            pass
+        if view:
+            remaining = (deadline_ns - time.perf_counter_ns()) / 1e9
+            if remaining <= 0:
+                raise SerialTimeoutException("port write timed out")
+            select.select([], [fd], [], remaining)
+
+def drain_port(sp, fd, deadline_ns) -> None:
+    """
+    Wait until the driver's output queue is empty, i.e. the frame is on the wire.
+    Polled against deadline_ns rather than tcdrain()/flush(), which never time out
+    (and pyserial's Windows flush() sleeps in 50 ms steps). Past the deadline the
+    link counts as stuck: SerialTimeoutException, retried like a failed write.
+    """
+    while True:
+        if fd is not None:
+            if _TIOCOUTQ is None:
+                return
+            queued = struct.unpack("i", fcntl.ioctl(fd, _TIOCOUTQ, b"\0\0\0\0"))[0]
+        else:
+            queued = sp.out_waiting
+        if not queued:
+            return
+        if time.perf_counter_ns() >= deadline_ns:
+            raise SerialTimeoutException("port write did not drain")
+        time.sleep(DRAIN_POLL_SEC)
+
 #for serial crashes that can happen if arduino is overvolted by back EMI from relays
-def safe_write(pin, value) -> bool:
-    """Write to a Firmata pin but don't crash if USB/serial drops."""
-    try:
-        pin.write(value)
+def write_port(sp, mask, bits, force=False) -> bool:
+    """
+    Set the bits in mask to bits in the cached port byte and send it in one write.
+    Nothing is sent if the byte wouldn't change (the board latches its outputs),
+    unless force or the board's actual state is unknown.
+    """
+    global _port_known
+    state = (_port_state[0] & ~mask) | (bits & mask)
+    if _port_known and state == _port_state[0] and not force:
         return True
-    except (OSError, SerialException) as e:
-        print(f"[SERIAL LOST] {e}")
+    # a relay EMI spike can stall the USB serial briefly; retry with backoff
+    # (10, 20, 40 ms) before giving up, so a sweep survives a hiccup
+    for attempt in range(SERIAL_RETRIES + 1):
+        try:
+            t_ns = time.perf_counter_ns()
+            deadline_ns = t_ns + int(SERIAL_WRITE_TIMEOUT_SEC * 1e9)
+            fd = _raw_fd if sp is _raw_sp else None
+            if fd is not None:
+                raw_write(fd, PORT_MSGS[state], deadline_ns)
+            else:
+                sp.write(PORT_MSGS[state])   # bounded by sp.write_timeout
+            # wait until the frame has actually gone out, so the settle/pulse
+            # timing that follows starts from the wire, not the buffer
+            drain_port(sp, fd, deadline_ns)
+            _write_lat_ns.append(time.perf_counter_ns() - t_ns)
+            break
+        except (OSError, SerialException) as e:
+            if attempt == SERIAL_RETRIES:
+                print(f"[SERIAL LOST] {e}")
+                _port_known = False
+                return False
+            time.sleep(0.01 * 2 ** attempt)
+    if attempt:
+        print(f"[SERIAL RECOVERED] after {attempt} retr{'y' if attempt == 1 else 'ies'}")
+    _port_state[0] = state
+    _port_known = True
+    return True
+
+def safe_write(pin, value, force=False) -> bool:
+    """Write to a Firmata pin but don't crash if USB/serial drops."""
+    bit = 1 << (pin.pin_number % 8)
+    if not write_port(pin.board.sp, bit, bit if value else 0, force=force):
         return False
+    # keep pyfirmata's own bookkeeping in step, in case anything still goes through
+    # Pin/Port.write (which would otherwise resend stale values for the other pin)
+    pin.value = value
+    return True
+
+def shutter_cached(state) -> bool:
+    """True if the last port write we sent left the shutter pin at state."""
+    return bool(_port_state[0] & SHUTTER_BIT) == bool(state)
+
+def set_outputs(shutter_pin, sel_pin, shutter_state, relay_state, force=False) -> bool:
+    """Shutter and relay in one DIGITAL_MESSAGE."""
+    bits = (SHUTTER_BIT if shutter_state else 0) | (SELECT_BIT if relay_state else 0)
+    if not write_port(shutter_pin.board.sp, SHUTTER_BIT | SELECT_BIT, bits, force=force):
+        return False
+    # same pyfirmata bookkeeping as safe_write, for both pins
+    shutter_pin.value = shutter_state
+    sel_pin.value = relay_state
+    return True
+
+def set_low_latency(sp) -> None:
+    """
+    Ask the USB-serial driver to stop buffering (FTDI latency_timer defaults to 16 ms,
+    which otherwise sets the floor under every write). Best effort: silently skipped
+    where unsupported or not permitted.
+    """
+    try:
+        sp.set_low_latency_mode(True)   # pyserial, Linux only (ASYNC_LOW_LATENCY)
+    except (AttributeError, NotImplementedError, OSError, ValueError):
+        pass
+    # FTDI on Linux: 1 ms latency timer (usually needs root or a udev rule)
+    try:
+        dev = os.path.basename(os.path.realpath(sp.port))
+        with open(f"/sys/bus/usb-serial/devices/{dev}/latency_timer", "w") as f:
+            f.write("1")
+    except (OSError, TypeError):
+        pass
+    # macOS (the /dev/cu.* ports above): pyserial has no low-latency call there, but
+    # the serial driver takes a receive latency (microseconds) via IOSSDATALAT
+    if sys.platform == "darwin" and fcntl is not None:
+        try:
+            IOSSDATALAT = 0x80085400   # _IOW('T', 0, unsigned long)
+            fcntl.ioctl(sp.fileno(), IOSSDATALAT, struct.pack("L", 1))
+        except (OSError, ValueError, AttributeError):
+            pass
 
 # Wiring assumption:
 # Shutter A on NC (default when relays OFF)  -> COM->NC
@@ -65,15 +226,23 @@ def select_shutter_b(sel_pin) -> bool:
     return safe_write(sel_pin, RELAY_ON)   # relays ON  => NO => Shutter B
 
 
-def open_shutter(pin, delay=False) -> bool:
+_last_switch_ts = 0.0   # perf_counter() when the last relay switch settled (projected while settling)
+
+def wait_after_switch() -> None:
+    """Only wait out whatever is left of DELAY_BEFORE_COMMAND since the last relay switch."""
+    remaining = DELAY_BEFORE_COMMAND - (time.perf_counter() - _last_switch_ts)
+    if remaining > 0:
+        time.sleep(remaining)
+
+def open_shutter(pin, delay=False, force=False) -> bool:
     if delay:
-        time.sleep(DELAY_BEFORE_COMMAND)
-    return safe_write(pin, OPEN_STATE)
+        wait_after_switch()
+    return safe_write(pin, OPEN_STATE, force=force)
 
-def close_shutter(pin, delay=False) -> bool:
+def close_shutter(pin, delay=False, force=False) -> bool:
     if delay:
-        time.sleep(DELAY_BEFORE_COMMAND)
-    return safe_write(pin, CLOSED_STATE)
+        wait_after_switch()
+    return safe_write(pin, CLOSED_STATE, force=force)
 
 #calculate commanded pulse for desired effective open time
 def cmd_for_effective_ms(target_ms: float) -> int:
@@ -84,11 +253,34 @@ def cmd_for_effective_ms(target_ms: float) -> int:
     cmd = (target_ms + CAL_B) / CAL_A
     return max(1, int(round(cmd)))
 
+SPIN_MS = 2.0   # last part of a pulse is busy-waited; time.sleep alone jitters by ms
+
+def wait_until_ns(deadline_ns: int) -> None:
+    """Sleep most of the way to a perf_counter_ns deadline, then spin the rest."""
+    remaining_ms = (deadline_ns - time.perf_counter_ns()) / 1e6
+    if remaining_ms > SPIN_MS + 1:
+        time.sleep((remaining_ms - SPIN_MS) / 1000.0)
+    while time.perf_counter_ns() < deadline_ns:
+        pass
+
+def raise_priority() -> None:
+    """Best effort: run the timing loop at real-time / high priority."""
+    try:
+        if hasattr(os, "sched_setscheduler"):   # Linux (needs CAP_SYS_NICE)
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+        elif sys.platform == "win32":
+            import ctypes
+            k32 = ctypes.windll.kernel32
+            k32.SetThreadPriority(k32.GetCurrentThread(), 15)   # THREAD_PRIORITY_TIME_CRITICAL
+    except (OSError, AttributeError):
+        pass
+
 def _pulse_shutter_raw(pin, cmd_ms: int) -> bool:
     #actuate the shutter for cmd_ms milliseconds (no compensation)
     if not open_shutter(pin):
         return False
-    time.sleep(cmd_ms / 1000.0)
+    # time the open interval from when the open command has been written
+    wait_until_ns(time.perf_counter_ns() + int(cmd_ms * 1_000_000))
     return close_shutter(pin)
 
 def pulse_shutter(pin, duration_ms: int, offset: bool = True) -> bool:
@@ -105,6 +297,36 @@ def relay_on(sel_pin) -> bool:
 def relay_off(sel_pin) -> bool:
     return safe_write(sel_pin, RELAY_OFF)
 
+_feedback_pin = None   # pyfirmata input Pin for SETTLE_FEEDBACK_PIN, set up in main()
+
+def wait_relay_settle(board, relay_state) -> None:
+    """
+    With a feedback pin: return once it has shown relay_state for SETTLE_STABLE_SEC
+    (POST_SWITCH_SETTLE_SEC is still the ceiling). Without one: the fixed wait.
+    """
+    if _feedback_pin is None:
+        time.sleep(POST_SWITCH_SETTLE_SEC)
+        return
+    want = (relay_state == RELAY_ON) != SETTLE_FEEDBACK_INVERT
+    t_end = time.perf_counter() + POST_SWITCH_SETTLE_SEC
+    stable_since = None
+    while True:
+        now = time.perf_counter()
+        if now >= t_end:
+            print("[WARN] relay feedback did not settle; used the full POST_SWITCH_SETTLE_SEC")
+            return
+        # no iterator thread: parse the board's digital reports here
+        while board.bytes_available():
+            board.iterate()
+        if bool(_feedback_pin.value) == want:
+            if stable_since is None:
+                stable_since = now
+            elif now - stable_since >= SETTLE_STABLE_SEC:
+                return
+        else:
+            stable_since = None
+        time.sleep(0.005)
+
 def safe_select(target: str, sel_pin, shutter_pin) -> bool:
     """
     Safe relay switch:
@@ -113,7 +335,14 @@ def safe_select(target: str, sel_pin, shutter_pin) -> bool:
       3) switch the relay
       4) wait for contacts to settles 
       5) optional: close again (new shutter known state)
+
+    Each step is its own port write on purpose. Sending the relay switch and the
+    close in one frame would energize the new shutter while the contacts are still
+    bouncing, which is what the settle wait is there to avoid. FAST_SWITCH does
+    exactly that (steps 3 and 5 in one frame) for when speed matters more.
     """
+    global _last_switch_ts
+
     # if not close_shutter(shutter_pin):
     #     return False
     # time.sleep(PRE_SWITCH_CLOSE_SEC)
@@ -123,7 +352,15 @@ def safe_select(target: str, sel_pin, shutter_pin) -> bool:
         return False
     time.sleep(PRE_SWITCH_OPEN_SEC)
 
-    if target.upper() == "A":
+    relay_state = RELAY_OFF if target.upper() == "A" else RELAY_ON
+    fold_close = FAST_SWITCH and SECOND_CLOSE_AFTER_SWITCH
+    # Until the settle below completes, count the switch as settling through the full
+    # POST_SWITCH_SETTLE_SEC: if Ctrl-C aborts it (or lands mid-write), the next o/c
+    # still waits that out instead of energizing a coil through bouncing contacts.
+    _last_switch_ts = time.perf_counter() + POST_SWITCH_SETTLE_SEC
+    if fold_close:
+        ok = set_outputs(shutter_pin, sel_pin, CLOSED_STATE, relay_state)
+    elif target.upper() == "A":
         ok = select_shutter_a(sel_pin)
     else:
         ok = select_shutter_b(sel_pin)
@@ -131,55 +368,294 @@ def safe_select(target: str, sel_pin, shutter_pin) -> bool:
     if not ok:
         return False
 
-    time.sleep(POST_SWITCH_SETTLE_SEC)
+    wait_relay_settle(sel_pin.board, relay_state)
+    _last_switch_ts = time.perf_counter()
 
-    if SECOND_CLOSE_AFTER_SWITCH:
+    if SECOND_CLOSE_AFTER_SWITCH and not fold_close:
         if not close_shutter(shutter_pin):
             return False
         time.sleep(0.1)
 
     return True
 
-def sweep_pulses(shutter_pin, durations_ms, gap_s=2.0, offset=False):
+def sweep_pulses(shutter_pin, durations_ms, gap_s=2.0, offset=False, cmds_ms=None):
     """
     Runs a repeatable pulse train while you record on the camera.
     Prints timestamps so you can correlate to video if needed.
+    cmds_ms: commanded widths for durations_ms if already converted (skips the offset math).
     """
-    t0 = time.perf_counter()
-    for ms in durations_ms:
-        # ensure closed baseline before each test pulse
+    # Pulses are scheduled on an absolute clock (gap, pulse, gap, pulse, ...) so
+    # sleep/serial jitter doesn't accumulate over the sweep. The whole schedule is
+    # worked out up front: start of pulse i = (i+1) gaps + all earlier pulse widths.
+    if cmds_ms is None:
+        cmds_ms = [cmd_for_effective_ms(ms) if offset else int(ms) for ms in durations_ms]
+    gap_ns = int(gap_s * 1e9)
+    starts_ns = [(i + 1) * gap_ns + before_ms * 1_000_000
+                 for i, before_ms in enumerate(accumulate([0] + cmds_ms[:-1]))]
+
+    late_ms = []
+    t0 = time.perf_counter_ns()
+    for ms, cmd_ms, start_ns in zip(durations_ms, cmds_ms, starts_ns):
+        # ensure closed baseline before each test pulse (a completed pulse already
+        # ended closed, so this only writes before the first one or after a failure)
         close_shutter(shutter_pin)
-        time.sleep(gap_s)
+        wait_until_ns(t0 + start_ns)
 
-        print(f"[{time.perf_counter()-t0:8.3f}s] PULSE {ms} ms")
-        pulse_shutter(shutter_pin, ms, offset=offset)
+        late_ms.append((time.perf_counter_ns() - t0 - start_ns) / 1e6)
+        print(f"[{start_ns/1e9:8.3f}s] PULSE {ms} ms  (late {late_ms[-1]:.3f} ms)")
+        _pulse_shutter_raw(shutter_pin, cmd_ms)
 
     close_shutter(shutter_pin)
+    if late_ms:
+        print(f"Start lateness: mean {sum(late_ms)/len(late_ms):.3f} ms, max {max(late_ms):.3f} ms")
     print("Sweep done.")
 
 
+# ---- REPL commands ----
+# Each handler takes (parts, ctx) and returns False to leave the command loop
+# (quit, or serial lost).
+
+@dataclass
+class ExitState:
+    """Outputs to leave behind when the script ends (defaults from the config above)."""
+    mode: str = EXIT_MODE           # "open" or "closed"
+    relay: str = EXIT_RELAY         # "on" or "off"
+    board_exit: bool = DO_BOARD_EXIT
+
+class Session:
+    """State shared by the command handlers."""
+    def __init__(self, shutter_pin, sel_pin, current="A"):
+        self.shutter_pin = shutter_pin
+        self.sel_pin = sel_pin
+        self.current = current   # selected shutter, "A" or "B"
+        self.exit = ExitState()  # replaced by the q* commands
+
+# o/c always write (force): a user re-assert is free, and it also fixes the pins
+# after a board reset the port cache hasn't noticed yet
+def cmd_open(parts, ctx) -> bool:
+    if not open_shutter(ctx.shutter_pin, delay=True, force=True):
+        return False
+    print(f"Shutter {ctx.current}: OPEN")
+    return True
+
+def cmd_close(parts, ctx) -> bool:
+    if not close_shutter(ctx.shutter_pin, delay=True, force=True):
+        return False
+    print(f"Shutter {ctx.current}: CLOSED")
+    return True
+
+def cmd_pulse(parts, ctx) -> bool:
+    duration_ms = 1000
+    if len(parts) > 1:
+        try:
+            duration_ms = int(parts[1])
+        except ValueError:
+            print("Invalid ms; using default 1000.")
+    print(f"Pulsing Shutter {ctx.current} open for {duration_ms} ms...")
+    return pulse_shutter(ctx.shutter_pin, duration_ms)
+
+def cmd_select_a(parts, ctx) -> bool:
+    print("Switching to Shutter B...please wait 10 seconds for safety before sending commands.")
+    if not safe_select("A", ctx.sel_pin, ctx.shutter_pin):
+        return False
+    ctx.current = "A"
+    print("Selected Shutter A (relays OFF -> NC)")
+    return True
+
+def cmd_select_b(parts, ctx) -> bool:
+    print("Switching to Shutter B...please wait 10 seconds for safety before sending commands.")
+    if not safe_select("B", ctx.sel_pin, ctx.shutter_pin):
+        return False
+    ctx.current = "B"
+    time.sleep(5.0)
+    print("Selected Shutter B (relays ON -> NO)")
+
+    # #testing states 
+    # #close_shutter(shutter_pin)  # ensure closed after switch
+    # open_shutter(shutter_pin)   # optional: open after switch
+    # close_shutter(shutter_pin)  # ensure closed after test
+    return True
+
+def cmd_relay_test(parts, ctx) -> bool:
+    print("Relay toggle test (SAFE): A -> B -> A -> B -> A")
+    for _ in range(2):
+        if not safe_select("A", ctx.sel_pin, ctx.shutter_pin): break
+        print("  A (OFF)"); time.sleep(0.4)
+        if not safe_select("B", ctx.sel_pin, ctx.shutter_pin): break
+        print("  B (ON)"); time.sleep(0.4)
+    if not safe_select("A", ctx.sel_pin, ctx.shutter_pin):
+        return False
+    print("  A (OFF)")
+    ctx.current = "A"
+    print("Relay test done.")
+    return True
+
+# sweeps for timing characterization in milliseconds
+SWEEP_DURATIONS1 = [10,20,30,50,75,100,150,200,250,260,270,280,287,290,300,310,500,750,1000,1500,2000,2500,3000,4000]
+SWEEP_DURATIONS2 = [10,12,15,17,20,22,24,26,28,30,32,34,36,38,40,42,45,50,60,75,80,85,100,150]
+SWEEP_DURATIONS3 = [10,11,12,13,14,15,16,17,18,19,20,22,24,26,28,30]
+SWEEP_DURATIONS4 = [75,76,77,78,79,80,81,82,83,84,85]
+SWEEP_OFFSET_DURATIONS = SWEEP_DURATIONS1
+# commanded pulse widths for the offset sweep, converted once at import
+SWEEP_OFFSET_CMDS_MS = [cmd_for_effective_ms(ms) for ms in SWEEP_OFFSET_DURATIONS]
+
+def cmd_sweep(parts, ctx) -> bool:
+    gap_s = 3.0 # gap between pulses in seconds 
+    print("Starting sweep. Start ASICap recording now.")
+    time.sleep(5.0)
+    sweep_pulses(ctx.shutter_pin, durations_ms=SWEEP_DURATIONS4, gap_s=gap_s, offset=False)
+    return True
+
+def cmd_sweep_offset(parts, ctx) -> bool:
+    gap_s = 2.0 # gap between pulses in seconds
+    print("Starting sweep with offset compensation. Start ASICap recording now.")
+    time.sleep(5.0)
+    sweep_pulses(ctx.shutter_pin, durations_ms=SWEEP_OFFSET_DURATIONS, gap_s=gap_s,
+                 offset=True, cmds_ms=SWEEP_OFFSET_CMDS_MS)
+    return True
+
+def abort_command(ctx) -> None:
+    """After Ctrl-C mid-command: report where the outputs were left (from the cached port byte)."""
+    global _port_known
+    # the interrupt may have landed inside write_port (after the write but before the
+    # cache update, or in a retry backoff), so the board may not match _port_state;
+    # make the next command resend the whole port byte instead of deduping against it
+    _port_known = False
+    relays_on = bool(_port_state[0] & SELECT_BIT) == bool(RELAY_ON)
+    ctx.current = "B" if relays_on else "A"   # a switch may or may not have happened
+    shutter = "OPEN" if shutter_cached(OPEN_STATE) else "CLOSED"
+    print(f"\n[ABORTED] Shutter {ctx.current} selected, {shutter} (outputs re-sent on the next command).")
+
+def _quit(mode, relay, msg):
+    def handler(parts, ctx) -> bool:
+        ctx.exit = ExitState(mode, relay)
+        print(msg)
+        return False
+    return handler
+
+def cmd_latency(parts, ctx) -> bool:
+    lat = sorted(_write_lat_ns)
+    if not lat:
+        print("No port writes yet.")
+        return True
+    def pct(q):
+        return lat[min(len(lat) - 1, int(q * len(lat)))] / 1e6
+    print(f"Port write+drain over last {len(lat)} writes: "
+          f"p50 {pct(0.50):.3f} ms, p95 {pct(0.95):.3f} ms, max {lat[-1]/1e6:.3f} ms")
+    return True
+
+def cmd_unknown(parts, ctx) -> bool:
+    # listed from COMMANDS so new commands show up here without another edit
+    print("Unknown command. Use: " + ", ".join("p <ms>" if k == "p" else k for k in COMMANDS))
+    return True
+
+COMMANDS = {
+    'o': cmd_open,
+    'c': cmd_close,
+    'p': cmd_pulse,
+    'ra': cmd_select_a,
+    'rb': cmd_select_b,
+    'rt': cmd_relay_test,
+    'sw': cmd_sweep,
+    'swo': cmd_sweep_offset,
+    'lat': cmd_latency,
+    # default quit behavior (change default if you want)
+    'q': _quit("open", "on", "Quitting (default: leave shutter OPEN) and RELAY ON. Use qc for forced closed exit. May require manual reset."),
+    'qc': _quit("closed", "on", "Quitting: leave shutter CLOSED (energized) and RELAY ON."),
+    'qoff': _quit("open", "off", "Quitting: leave shutter OPEN and relay OFF."),
+    'qcoff': _quit("closed", "off", "Quitting: leave shutter OPEN and relay OFF."),
+}
+
+
+def stdin_lines() -> queue.Queue:
+    """Read stdin lines on a daemon thread so the main loop never blocks in input()."""
+    lines = queue.Queue()
+
+    def reader():
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)   # EOF
+
+    threading.Thread(target=reader, daemon=True).start()
+    return lines
+
+def next_command(lines, sp, poll_s=0.05):
+    """
+    Prompt and wait for the next command line (None on EOF), draining whatever
+    the board sends in the meantime so it doesn't pile up in the serial buffer.
+    """
+    global _port_known
+    print("> ", end="", flush=True)
+    while True:
+        try:
+            return lines.get(timeout=poll_s)
+        except queue.Empty:
+            pass
+        try:
+            if sp.in_waiting and REPORT_VERSION in sp.read(sp.in_waiting):
+                # the board rebooted (e.g. relay EMI): its outputs are back at power-on
+                # levels, so stop trusting the cache and resend on the next command
+                _port_known = False
+                print("\n[WARN] Board reset detected; outputs will be re-sent on the next command.")
+                print("> ", end="", flush=True)
+        except (OSError, SerialException):
+            pass
+
+
+def wait_for_firmware(board, timeout_s=STARTUP_WAIT_SEC) -> bool:
+    """
+    Poll for Firmata's firmware report (REPORT_FIRMWARE sysex, sent once the sketch
+    is running) instead of sleeping a fixed time after the reset. pyfirmata's
+    constructor usually has it parsed already, in which case this returns at once.
+    """
+    deadline = time.perf_counter() + timeout_s
+    while board.firmware is None and time.perf_counter() < deadline:
+        if board.bytes_available():
+            board.iterate()
+        else:
+            time.sleep(0.05)
+    return board.firmware is not None
+
+
 def main(port=DEFAULT_PORT):
 
-    global EXIT_MODE, EXIT_RELAY
+    global _feedback_pin, _raw_sp, _raw_fd
 
     print(f"Connecting to Arduino on {port}...")
     board = Arduino(port)
+    set_low_latency(board.sp)
+    # a wedged USB link makes write() raise SerialTimeoutException (retried by
+    # write_port) instead of blocking forever. This only covers writes through
+    # pyserial (Windows, and pyfirmata's own); the POSIX fast path below applies
+    # the same SERIAL_WRITE_TIMEOUT_SEC itself in raw_write.
+    board.sp.write_timeout = SERIAL_WRITE_TIMEOUT_SEC
+    if termios is not None:
+        # POSIX fast path: 3-byte frames go straight to the fd, skipping pyserial's
+        # write wrapper
+        _raw_sp, _raw_fd = board.sp, board.sp.fileno()
+    try:
+        board.sp.set_buffer_size(rx_size=8192, tx_size=8192)   # Windows only
+    except (AttributeError, SerialException):
+        pass
+    raise_priority()
 
-    # Start Firmata iterator thread (improves robustness)
-    it = util.Iterator(board)
-    it.start()
+    # No util.Iterator thread: we only write outputs and never read inputs back,
+    # so it would just poll the port and compete with our writes.
 
-    # Arduino usually resets on connect
-    time.sleep(2.0)
+    # Arduino usually resets on connect; go as soon as Firmata has reported in
+    if not wait_for_firmware(board):
+        print(f"[WARN] No Firmata firmware report after {STARTUP_WAIT_SEC:.0f} s; continuing anyway.")
     print("Setting up pins...please wait...")
 
     shutter_pin = board.get_pin(f'd:{SHUTTER_PIN_NUM}:o')  # D8 output
     sel_pin     = board.get_pin(f'd:{SELECT_PIN_NUM}:o')   # D9 output
+    if SETTLE_FEEDBACK_PIN is not None:
+        _feedback_pin = board.get_pin(f'd:{SETTLE_FEEDBACK_PIN}:i')
+        _feedback_pin.enable_reporting()
 
     # Safe startup
     
-    print("Seting up, please wait ~10 seconds.")
-    time.sleep(5.0)
+    print("Seting up, please wait ~5 seconds.")
     select_shutter_a(sel_pin)
     current = "A"
     time.sleep(3.0)
@@ -197,143 +673,50 @@ def main(port=DEFAULT_PORT):
     print("  rt          -> relay toggle test (A<->B) [SAFE SWITCH]")
     print("  sw          -> enter Sweep Pulse mode (predefined pulse train) for testing")
     print("  swo         -> enter Sweep Pulse mode with offset compensation for testing")
+    print("  lat         -> serial write latency stats (p50/p95/max)")
     print("  q           -> quit")
     #print("  qc          -> quit, leaving selected shutter CLOSED (energized)")
     print(f"\nCurrent shutter: {current}")
 
+    ctx = Session(shutter_pin, sel_pin, current)
+    lines = stdin_lines()
     try:
         while True:
-            cmd_line = input("> ").strip()
-            if not cmd_line:
-                continue
-
-            parts = cmd_line.split()
-            cmd = parts[0].lower()
-
-            if cmd == 'o':
-                if not open_shutter(shutter_pin, delay=True):
-                    break
-                print(f"Shutter {current}: OPEN")
-
-            elif cmd == 'c':
-                if not close_shutter(shutter_pin, delay=True):
-                    break
-                print(f"Shutter {current}: CLOSED")
-
-            elif cmd == 'p':
-                duration_ms = 1000
-                if len(parts) > 1:
-                    try:
-                        duration_ms = int(parts[1])
-                    except ValueError:
-                        print("Invalid ms; using default 1000.")
-                print(f"Pulsing Shutter {current} open for {duration_ms} ms...")
-                if not pulse_shutter(shutter_pin, duration_ms):
-                    break
-
-            elif cmd == 'ra':
-                print("Switching to Shutter B...please wait 10 seconds for safety before sending commands.")
-                if not safe_select("A", sel_pin, shutter_pin):
-                    break
-                current = "A"
-                print("Selected Shutter A (relays OFF -> NC)")
-
-            elif cmd == 'rb':
-                print("Switching to Shutter B...please wait 10 seconds for safety before sending commands.")
-                if not safe_select("B", sel_pin, shutter_pin):
-                    break
-                current = "B"
-                time.sleep(5.0)
-                print("Selected Shutter B (relays ON -> NO)")
-
-                # #testing states 
-                # #close_shutter(shutter_pin)  # ensure closed after switch
-                # open_shutter(shutter_pin)   # optional: open after switch
-                # close_shutter(shutter_pin)  # ensure closed after test
-
-            elif cmd == 'rt':
-                print("Relay toggle test (SAFE): A -> B -> A -> B -> A")
-                for _ in range(2):
-                    if not safe_select("A", sel_pin, shutter_pin): break
-                    print("  A (OFF)"); time.sleep(0.4)
-                    if not safe_select("B", sel_pin, shutter_pin): break
-                    print("  B (ON)"); time.sleep(0.4)
-                if not safe_select("A", sel_pin, shutter_pin):
-                    break
-                print("  A (OFF)")
-                current = "A"
-                print("Relay test done.")
-
-            elif cmd == 'sw':
-                # sweep for timing characterization in milliseconds
-                durations1 = [10,20,30,50,75,100,150,200,250,260,270,280,287,290,300,310,500,750,1000,1500,2000,2500,3000,4000]
-                durations2 = [10,12,15,17,20,22,24,26,28,30,32,34,36,38,40,42,45,50,60,75,80,85,100,150]
-                durations3 = [10,11,12,13,14,15,16,17,18,19,20,22,24,26,28,30]
-                durations4 = [75,76,77,78,79,80,81,82,83,84,85]
-                gap_s = 3.0 # gap between pulses in seconds 
-                print("Starting sweep. Start ASICap recording now.")
-                time.sleep(5.0)
-                sweep_pulses(shutter_pin, durations_ms=durations4, gap_s=gap_s, offset=False)
-
-            elif cmd == 'swo':
-                # sweep for timing characterization in milliseconds
-                durations = [10,20,30,50,75,100,150,200,250,260,270,280,287,290,300,310,500,750,1000,1500,2000,2500,3000,4000]
-                gap_s = 2.0 # gap between pulses in seconds
-                print("Starting sweep with offset compensation. Start ASICap recording now.")
-                time.sleep(5.0)
-                sweep_pulses(shutter_pin, durations_ms=durations, gap_s=gap_s, offset=True)
-
-            elif cmd == 'q':
-                # default quit behavior
-                EXIT_MODE = "open"   # change default if you want
-                EXIT_RELAY = "on"
-                print("Quitting (default: leave shutter OPEN) and RELAY ON. Use qc for forced closed exit. May require manual reset.")
-                break
-                
-            elif cmd == 'qc':
-                EXIT_MODE = "closed"
-                EXIT_RELAY = "on"
-                print("Quitting: leave shutter CLOSED (energized) and RELAY ON.")
-                break
-
-            elif cmd == 'qoff':
-                EXIT_MODE = "open"
-                EXIT_RELAY = "off"
-                print("Quitting: leave shutter OPEN and relay OFF.")
+            cmd_line = next_command(lines, board.sp)
+            if cmd_line is None:   # stdin closed (e.g. end of a piped command file)
                 break
+            parts = cmd_line.split()   # no strip() needed: split() drops the whitespace/newline
+            if not parts:
+                continue
 
-            elif cmd == 'qcoff':
-                EXIT_MODE = "closed"
-                EXIT_RELAY = "off"
-                print("Quitting: leave shutter OPEN and relay OFF.")
+            handler = COMMANDS.get(parts[0].lower(), cmd_unknown)
+            # Ctrl-C during a command (settle waits, sweeps) aborts just that command;
+            # lines typed while it ran are already queued by the stdin thread.
+            # Ctrl-C at the prompt still quits.
+            try:
+                keep_going = handler(parts, ctx)
+            except KeyboardInterrupt:
+                abort_command(ctx)
+                continue
+            if not keep_going:
                 break
 
-
-            else:
-                print("Unknown command. Use: o, c, p <ms>, ra, rb, rt, q")
-
     finally:
         print("Exiting...setting final states...")
 
-        #1) Shutter exit state (skip the 1s command delay on exit)
+        # Shutter + relay exit states in one port write (skip the 1s command delay on exit)
         try:
-            if EXIT_MODE == "open":
-                open_shutter(shutter_pin, delay=False)
-                print("Exit mode: Shutter OPEN (de-energized).")
-            else:
-                close_shutter(shutter_pin, delay=False)
-                print("Exit mode: Shutter CLOSED.")
-        except Exception:
-            pass
-
-        #2) Relay exit state
-        try:
-            if EXIT_RELAY == "on":
-                relay_on(sel_pin)   # RELAY_ON (active-low -> write(0)) => LEDs on
-                print("Exit mode: Relay ON (energized, LEDs on).")
-            else:
-                relay_off(sel_pin)
-                print("Exit mode: Relay OFF.")
+            shutter_state = OPEN_STATE if ctx.exit.mode == "open" else CLOSED_STATE
+            relay_state = RELAY_ON if ctx.exit.relay == "on" else RELAY_OFF
+            if set_outputs(shutter_pin, sel_pin, shutter_state, relay_state, force=True):
+                if ctx.exit.mode == "open":
+                    print("Exit mode: Shutter OPEN (de-energized).")
+                else:
+                    print("Exit mode: Shutter CLOSED.")
+                if ctx.exit.relay == "on":
+                    print("Exit mode: Relay ON (energized, LEDs on).")   # RELAY_ON (active-low -> 0) => LEDs on
+                else:
+                    print("Exit mode: Relay OFF.")
         except Exception:
             pass
 
@@ -343,7 +726,7 @@ def main(port=DEFAULT_PORT):
         # IMPORTANT:
         # If you call board.exit(), pyFirmata shuts down comms and some boards may reset pins.
         # If you want the pin to remain latched, try leaving DO_BOARD_EXIT=False.
-        if DO_BOARD_EXIT:
+        if ctx.exit.board_exit:
             try:
                 board.exit()
             except Exception:
@@ -352,8 +735,20 @@ def main(port=DEFAULT_PORT):
         print("Done.")
 
 
+USAGE = "Usage: python ufo_shutter.py [port] [settle_sec]"
+
 if __name__ == "__main__":
     port = DEFAULT_PORT
     if len(sys.argv) > 1:
         port = sys.argv[1]
+    if len(sys.argv) > 2:
+        # relay contact settle after a switch (POST_SWITCH_SETTLE_SEC)
+        try:
+            POST_SWITCH_SETTLE_SEC = float(sys.argv[2])
+        except ValueError:
+            POST_SWITCH_SETTLE_SEC = -1.0
+        if not 0 <= POST_SWITCH_SETTLE_SEC < float("inf"):
+            print(f"Invalid settle_sec {sys.argv[2]!r}: expected seconds, e.g. 5.0")
+            print(USAGE)
+            sys.exit(1)
     main(port=port)
\ No newline at end of file